@@ -15,14 +15,16 @@
 # `google.colab.files` is for file uploads.
 # `nest_asyncio` is often needed in Colab environments when mixing asyncio with
 # event loops, which can happen with some libraries used by `google-generativeai`.
-# `PyPDF2` for robust PDF document processing.
+# `PyMuPDF` (imported as `fitz`) for fast PDF text extraction, with `PyPDF2` as a fallback.
+# The heavier libraries (`google-generativeai`, `ipywidgets`, and the PDF parsers) are only imported
+# in the steps that first use them, which keeps this cell fast and the notebook's memory footprint small.
 
 import sys
 
 print("Installing required packages...")
 try:
     # Suppress installation output for cleaner notebook
-    !{sys.executable} -m pip install google-generativeai ipywidgets nest_asyncio PyPDF2 --quiet
+    !{sys.executable} -m pip install google-generativeai ipywidgets nest_asyncio pymupdf PyPDF2 --quiet
     print("Packages installed successfully.")
 except Exception as e:
     print(f"Error installing packages: {e}")
@@ -31,13 +33,23 @@ except Exception as e:
     sys.exit(1)
 
 # Import necessary libraries after installation
-import google.generativeai as genai
-import ipywidgets as widgets
 from IPython.display import display, Markdown, HTML, clear_output
 from google.colab import userdata, files
+from charset_normalizer import from_bytes # Text encoding detection (installed as a dependency of requests)
 import nest_asyncio
-import PyPDF2
+import asyncio # For issuing concurrent API requests
 import io # For handling binary data from file uploads
+import os
+import hashlib # For content-hashing uploaded files
+import tempfile
+import json
+import re
+import math
+from collections import Counter # For TF-IDF scoring of reference passages
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor # For extracting PDFs on all CPU cores
+from concurrent.futures.process import BrokenProcessPool
 
 # Apply nest_asyncio for compatibility in Colab. This resolves potential asyncio runtime errors.
 nest_asyncio.apply()
@@ -72,26 +84,18 @@ try:
         if not API_KEY:
             raise ValueError("API Key cannot be empty.")
     
+    # Import the Gemini SDK only once there is a key to use it with
+    import google.generativeai as genai
+    from google.api_core import exceptions as google_exceptions # Typed API errors (installed with google-generativeai)
+
     # Configure the generative AI library with the API key
     genai.configure(api_key=API_KEY)
-    print("Google Gemini API configured successfully.")
-
-    # Test a small model call to ensure authentication works
-    try:
-        # Initialize a temporary model to make a small test query
-        model_test = genai.GenerativeModel('gemini-pro')
-        # Send a minimal request to check connectivity and API key validity
-        _ = model_test.generate_content("Hello", generation_config=genai.GenerationConfig(max_output_tokens=10))
-        print("API key validated: Connection to Gemini API successful.")
-        
-        # Initialize the main GenerativeModel for article generation
-        model = genai.GenerativeModel('gemini-pro')
 
-    except Exception as e:
-        print(f"API Key validation failed. Please check your key and ensure it has access to 'gemini-pro': {e}")
-        API_KEY = None # Invalidate key if test fails
-        print("Further operations requiring the Gemini API will not proceed.")
-        # sys.exit(1) # Do not exit, just mark model as None
+    # Initialize the main GenerativeModel for article generation.
+    # The key is not validated with a test request here, which would cost a round-trip and quota;
+    # an invalid key is reported by the first generation request in Step 5 instead.
+    model = genai.GenerativeModel('gemini-pro')
+    print("Google Gemini API configured successfully.")
 
 except Exception as e:
     print(f"Error configuring Google Gemini API: {e}")
@@ -103,6 +107,8 @@ except Exception as e:
 
 # @markdown Use the interactive widgets below to define the core aspects of your article.
 
+import ipywidgets as widgets
+
 # Initialize global variables for article details. These will store user inputs.
 ARTICLE_TOPIC = None
 ARTICLE_TONE = None
@@ -153,23 +159,30 @@ output_details = widgets.Output() # Output widget to show messages
 
 def on_confirm_details_clicked(b):
     """Callback function when the 'Confirm Article Details' button is clicked."""
-    with output_details:
-        clear_output() # Clear previous output in this section
-        global ARTICLE_TOPIC, ARTICLE_TONE, ARTICLE_STYLE # Access global variables
-        ARTICLE_TOPIC = topic_input.value.strip()
-        ARTICLE_TONE = tone_input.value
-        ARTICLE_STYLE = style_input.value
-
-        # Validate that the topic is not empty
-        if not ARTICLE_TOPIC:
-            print("Error: Article Topic cannot be empty. Please provide a topic.")
-            ARTICLE_TOPIC = None # Invalidate topic to prevent generation
-            return
-
-        print(f"Article Topic: '{ARTICLE_TOPIC}'")
-        print(f"Article Tone: '{ARTICLE_TONE}'")
-        print(f"Article Style: '{ARTICLE_STYLE}'")
-        print("\nArticle details confirmed. You can now proceed to upload reference documents (optional).")
+    # Disable the button while this runs so repeated clicks cannot start overlapping runs
+    b.disabled = True
+    b.description = "Confirming..."
+    try:
+        with output_details:
+            clear_output() # Clear previous output in this section
+            global ARTICLE_TOPIC, ARTICLE_TONE, ARTICLE_STYLE # Access global variables
+            ARTICLE_TOPIC = topic_input.value.strip()
+            ARTICLE_TONE = tone_input.value
+            ARTICLE_STYLE = style_input.value
+
+            # Validate that the topic is not empty
+            if not ARTICLE_TOPIC:
+                print("Error: Article Topic cannot be empty. Please provide a topic.")
+                ARTICLE_TOPIC = None # Invalidate topic to prevent generation
+                return
+
+            print(f"Article Topic: '{ARTICLE_TOPIC}'")
+            print(f"Article Tone: '{ARTICLE_TONE}'")
+            print(f"Article Style: '{ARTICLE_STYLE}'")
+            print("\nArticle details confirmed. You can now proceed to upload reference documents (optional).")
+    finally:
+        b.disabled = False
+        b.description = "Confirm Article Details"
 
 # Attach the callback function to the button's click event
 confirm_button.on_click(on_confirm_details_clicked)
@@ -186,82 +199,226 @@ display(confirm_button, output_details) # Display the button and its output area
 REFERENCE_MATERIAL = ""
 
 def read_text_file(uploaded_file_content):
-    """Reads content from a text-based file (e.g., .txt, .md) with UTF-8 and Latin-1 fallback."""
+    """Reads content from a text-based file (e.g., .txt, .md), detecting its encoding if it is not UTF-8."""
     try:
-        return uploaded_file_content.decode('utf-8')
+        return uploaded_file_content.decode('utf-8') # Fast path for the common case
     except UnicodeDecodeError:
-        try:
-            return uploaded_file_content.decode('latin-1') # Fallback for other encodings
-        except Exception as e:
-            print(f"Could not decode text file: {e}")
-            return None
+        pass
+    try:
+        # Detect the actual encoding (UTF-16, CP-1252, ...) instead of guessing Latin-1
+        best_match = from_bytes(uploaded_file_content).best()
+        if best_match is not None:
+            return str(best_match)
+    except Exception as e:
+        print(f"Could not detect text file encoding: {e}")
+    # No confident match: decode as UTF-8, replacing invalid bytes rather than failing
+    return uploaded_file_content.decode('utf-8', errors='replace')
+
+# PDFs with at least this many pages are split into page ranges and extracted in parallel.
+PARALLEL_PDF_MIN_PAGES = 10
+# Each worker task covers at most this many pages, so a document's parsed objects are freed between windows.
+PDF_PAGE_WINDOW = 32
+PDF_MAX_WORKERS = 8 # Upper bound on worker processes used for PDF extraction
+# Each worker is a fork of the whole kernel and lives for the session, so the pool is capped
+PDF_WORKERS = min(PDF_MAX_WORKERS, os.cpu_count() or 1)
+
+# MuPDF is not thread-safe, so PyMuPDF only ever runs in worker processes. All uploads share one
+# process pool, which lets several PDFs (and the pages of a large PDF) be extracted at the same time.
+_PDF_POOL = None
+_PDF_POOL_LOCK = threading.Lock()
+
+def get_pdf_pool():
+    """Returns the process pool shared by all PDF extractions, creating it on first use."""
+    global _PDF_POOL
+    with _PDF_POOL_LOCK:
+        if _PDF_POOL is None:
+            _PDF_POOL = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("fork"))
+        return _PDF_POOL
+
+def count_pdf_pages(pdf_path):
+    """Returns the number of pages of a PDF. Runs in a worker process."""
+    import fitz # PyMuPDF, imported on first use
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+def extract_pdf_pages(pdf_path, start, stop):
+    """Extracts the text of pages [start, stop) of a PDF. Runs in a worker process."""
+    import fitz # PyMuPDF, imported on first use
+    with fitz.open(pdf_path) as doc:
+        return [doc[page_num].get_text("text") for page_num in range(start, stop)]
 
 def read_pdf_file(uploaded_file_content):
-    """Reads content from a PDF file using PyPDF2."""
+    """Reads content from a PDF file using PyMuPDF, falling back to PyPDF2."""
+    global _PDF_POOL
     try:
-        # PyPDF2 expects a file-like object, so we use io.BytesIO
+        # Workers open the PDF from a temporary file, so tasks only carry its path
+        # instead of each pickling its own copy of the bytes
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(uploaded_file_content)
+            pool = get_pdf_pool()
+            # PyMuPDF parses the raw bytes in C, which is much faster than PyPDF2's pure-Python parser
+            page_count = pool.submit(count_pdf_pages, pdf_path).result()
+            if page_count < PARALLEL_PDF_MIN_PAGES:
+                step = max(page_count, 1) # Small PDFs are a single task
+            else:
+                step = min(-(-page_count // PDF_WORKERS), PDF_PAGE_WINDOW) # Ceiling division so every page is covered
+            futures = [pool.submit(extract_pdf_pages, pdf_path, start, min(start + step, page_count))
+                       for start in range(0, page_count, step)]
+            return "\n".join(text for future in futures for text in future.result())
+        finally:
+            os.remove(pdf_path)
+    except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            _PDF_POOL = None # A worker died; start a fresh pool for the next PDF
+        print(f"PyMuPDF could not read the PDF ({e}). Falling back to PyPDF2...")
+
+    try:
+        import PyPDF2 # Only needed when PyMuPDF fails
+        # PyPDF2 expects a file-like object. io.BytesIO shares the bytes' buffer until it is
+        # written to, so wrapping the upload does not copy it.
         pdf_file = io.BytesIO(uploaded_file_content)
-        reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        # Iterate through all pages and extract text
-        for page_num in range(len(reader.pages)):
-            page = reader.pages[page_num]
-            text += page.extract_text() + "\n" # Add a newline between page contents
-        return text
+        reader = PyPDF2.PdfReader(pdf_file, strict=False) # Tolerate minor defects instead of validating everything
+        # Iterate through all pages in order and extract text
+        page_texts = [page.extract_text() or "" for page in reader.pages]
+        return "\n".join(page_texts) # Join once, with a newline between page contents
     except Exception as e:
         print(f"Error reading PDF file: {e}")
         return None
 
+# Text extractor for each supported file extension. Support for a new format only needs an entry here.
+FILE_READERS = {
+    'txt': read_text_file,
+    'md': read_text_file,
+    'pdf': read_pdf_file,
+}
+
+# Extracted reference text is cached on disk, one JSON file per SHA-256 of the uploaded bytes,
+# so re-uploading the same document skips decoding and PDF parsing entirely.
+REF_CACHE_DIR = "/content/.ref_cache"
+HASH_CHUNK_SIZE = 64 * 1024 # Feed the hash 64 KB at a time
+
+def compute_file_hash(uploaded_file_content):
+    """Computes the SHA-256 hex digest of an uploaded file's bytes."""
+    digest = hashlib.sha256()
+    view = memoryview(uploaded_file_content) # Slicing a memoryview does not copy the bytes
+    for offset in range(0, len(view), HASH_CHUNK_SIZE):
+        digest.update(view[offset:offset + HASH_CHUNK_SIZE])
+    return digest.hexdigest()
+
+def save_text_atomically(path, text):
+    """
+    Writes text to path through a temporary file and os.replace, so an interrupted write never
+    leaves a truncated file behind. Returns True on success.
+    """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        return True
+    except OSError as e:
+        print(f"Could not save '{path}': {e}")
+        return False
+
+def load_cached_text(file_hash):
+    """Returns previously extracted text for a file hash, or None on a cache miss."""
+    try:
+        with open(os.path.join(REF_CACHE_DIR, f"{file_hash}.json"), encoding="utf-8") as f:
+            return json.load(f)["text"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def store_cached_text(file_hash, text):
+    """Saves extracted text under its file hash so identical uploads can skip extraction."""
+    save_text_atomically(os.path.join(REF_CACHE_DIR, f"{file_hash}.json"), json.dumps({"text": text}))
+
+def process_uploaded_file(filename, content):
+    """
+    Extracts the text of one uploaded file, reusing cached text when available.
+    Returns a (filename, extracted_text, status_message) tuple. Runs in a worker thread.
+    """
+    file_extension = os.path.splitext(filename)[1][1:].lower() # Get file extension without the dot
+    read_file = FILE_READERS.get(file_extension)
+    if read_file is None:
+        supported = ", ".join(f".{extension}" for extension in FILE_READERS)
+        return filename, None, f"Skipping unsupported file type: '{filename}' (only {supported} are supported)."
+
+    # Reuse the text extracted from an identical upload, if any
+    file_hash = compute_file_hash(content)
+    extracted_text = load_cached_text(file_hash)
+    if extracted_text is not None:
+        return filename, extracted_text, f"Reused previously extracted text for '{filename}'. Content length: {len(extracted_text)} characters."
+
+    extracted_text = read_file(content)
+    if not extracted_text:
+        return filename, None, f"Failed to extract text from '{filename}'. It might be empty or corrupted."
+    store_cached_text(file_hash, extracted_text)
+    return filename, extracted_text, f"Successfully processed '{filename}'. Content length: {len(extracted_text)} characters."
+
+async def process_uploaded_files(uploaded):
+    """Extracts all uploaded files concurrently. Results keep the upload order."""
+    return await asyncio.gather(*[
+        asyncio.to_thread(process_uploaded_file, filename, content)
+        for filename, content in uploaded.items()
+    ])
+
 upload_button = widgets.Button(description="Upload Reference Documents")
 output_upload = widgets.Output() # Output widget for upload messages
 
 def on_upload_clicked(b):
     """Callback function when the 'Upload Reference Documents' button is clicked."""
     global REFERENCE_MATERIAL
-    REFERENCE_MATERIAL = "" # Reset reference material for new uploads or to clear previous
-    with output_upload:
-        clear_output() # Clear previous output in this section
-        print("Please select your reference files to upload (txt, md, pdf):")
-        try:
-            # Use google.colab.files.upload() for the file picker
-            uploaded = files.upload()
-            
-            if not uploaded:
-                print("No files selected or uploaded.")
-                return
-
-            # Process each uploaded file
-            for filename, content in uploaded.items():
-                print(f"Processing '{filename}'...")
-                file_extension = filename.split('.')[-1].lower() # Get file extension
+    # Disable the button while this runs. Clicks on a disabled button are not sent to the kernel,
+    # so repeated clicks cannot queue up overlapping runs.
+    b.disabled = True
+    b.description = "Uploading..."
+    try:
+        REFERENCE_MATERIAL = "" # Reset reference material for new uploads or to clear previous
+        with output_upload:
+            clear_output() # Clear previous output in this section
+            print("Please select your reference files to upload (txt, md, pdf):")
+            try:
+                # Use google.colab.files.upload() for the file picker
+                uploaded = files.upload()
                 
-                extracted_text = None
-                if file_extension in ['txt', 'md']:
-                    extracted_text = read_text_file(content)
-                elif file_extension == 'pdf':
-                    extracted_text = read_pdf_file(content)
-                else:
-                    print(f"Skipping unsupported file type: '{filename}' (only .txt, .md, .pdf are supported).")
-                    continue # Skip to the next file
+                if not uploaded:
+                    print("No files selected or uploaded.")
+                    return
+
+                # Process all uploaded files in parallel, so the wait is set by the slowest file
+                # rather than the sum of all of them
+                print(f"Processing {len(uploaded)} file(s)...")
+                results = asyncio.get_event_loop().run_until_complete(process_uploaded_files(uploaded))
+
+                reference_parts = []
+                for filename, extracted_text, status_message in results:
+                    print(status_message)
+                    if extracted_text:
+                        # Append extracted text with clear delimiters for the LLM
+                        reference_parts.extend([
+                            f"\n--- Start of Reference Document: {filename} ---\n",
+                            extracted_text,
+                            f"\n--- End of Reference Document: {filename} ---\n",
+                        ])
+                # Join once rather than re-copying the growing string for every piece
+                REFERENCE_MATERIAL = "".join(reference_parts)
                 
-                if extracted_text:
-                    # Append extracted text with clear delimiters for the LLM
-                    REFERENCE_MATERIAL += f"\n--- Start of Reference Document: {filename} ---\n"
-                    REFERENCE_MATERIAL += extracted_text
-                    REFERENCE_MATERIAL += f"\n--- End of Reference Document: {filename} ---\n"
-                    print(f"Successfully processed '{filename}'. Content length: {len(extracted_text)} characters.")
+                if REFERENCE_MATERIAL:
+                    print("\nAll selected reference documents processed. Content will be used for article generation.")
+                    print(f"Total combined reference material length: {len(REFERENCE_MATERIAL)} characters.")
                 else:
-                    print(f"Failed to extract text from '{filename}'. It might be empty or corrupted.")
-            
-            if REFERENCE_MATERIAL:
-                print("\nAll selected reference documents processed. Content will be used for article generation.")
-                print(f"Total combined reference material length: {len(REFERENCE_MATERIAL)} characters.")
-            else:
-                print("No usable reference material was uploaded or extracted.")
+                    print("No usable reference material was uploaded or extracted.")
 
-        except Exception as e:
-            print(f"An error occurred during file upload or processing: {e}")
-            REFERENCE_MATERIAL = "" # Clear reference material if error occurs to prevent using partial data
+            except Exception as e:
+                print(f"An error occurred during file upload or processing: {e}")
+                REFERENCE_MATERIAL = "" # Clear reference material if error occurs to prevent using partial data
+    finally:
+        b.disabled = False
+        b.description = "Upload Reference Documents"
 
 # Attach the callback function to the button's click event
 upload_button.on_click(on_upload_clicked)
@@ -274,140 +431,488 @@ display(upload_button, output_upload) # Display the button and its output area
 # Global variable to store the final generated article
 GENERATED_ARTICLE = ""
 
+# The article is saved here after every attempt, so a runtime disconnect does not lose it
+ARTICLE_PATH = "/content/generated_article.md"
+# Finished articles are cached here, keyed by a hash of the inputs that produced them
+ARTICLE_CACHE_DIR = "/content/.article_cache"
+
+def article_cache_path(topic, tone, style, reference_material, mode):
+    """Returns the article cache file for a combination of generation inputs."""
+    reference_hash = compute_file_hash(reference_material.encode("utf-8"))
+    key = compute_file_hash("\0".join([topic, tone, style, reference_hash, mode]).encode("utf-8"))
+    return os.path.join(ARTICLE_CACHE_DIR, f"{key}.md")
+
+# Matches one whitespace-delimited word
+_WORD_RE = re.compile(r"\S+")
+
 def count_words(text):
     """Helper function to count words in a string."""
     if not text:
         return 0
-    return len(text.split())
+    # Counting regex matches avoids building the list of substrings that text.split() allocates
+    return sum(1 for _ in _WORD_RE.finditer(text))
+
+# Generation configuration for the model.
+# max_output_tokens is crucial for longer responses. 8192 is a common max for Gemini Pro.
+# Temperature controls creativity (higher = more creative).
+GENERATION_SETTINGS = dict(
+    temperature=0.7,
+    top_p=0.95,
+    top_k=40,
+    max_output_tokens=8192, # Maximum tokens for the model's output
+)
+
+# Number of drafts requested on the first attempt; the longest one is kept.
+FIRST_ATTEMPT_CANDIDATES = 3
+# The first prompt asks for this multiple of the minimum word count, so one call is usually enough.
+TARGET_LENGTH_FACTOR = 1.4
+
+def stream_candidates(response_iter):
+    """
+    Consumes a streamed Gemini response, rendering the first candidate as chunks arrive.
+    Returns the full text of every candidate, ordered by candidate index.
+    """
+    parts = {}
+    running_words = 0
+    # A display handle lets us redraw the same output area instead of appending a new one per chunk
+    preview = display(Markdown("*Waiting for the first tokens...*"), display_id=True)
+    for chunk in response_iter:
+        for candidate in chunk.candidates:
+            chunk_text = "".join(part.text for part in candidate.content.parts)
+            if not chunk_text:
+                # Chunks without text parts (e.g. a final chunk carrying only the finish reason)
+                continue
+            parts.setdefault(candidate.index, []).append(chunk_text)
+            if candidate.index == 0:
+                running_words += count_words(chunk_text)
+                preview.update(Markdown("".join(parts[0]) + f"\n\n*... {running_words} words so far*"))
+        sys.stdout.flush() # Colab buffers output between chunks; flush so progress shows up immediately
+    preview.update(Markdown("*Draft complete.*"))
+    return ["".join(candidate_parts) for _, candidate_parts in sorted(parts.items())]
+
+# gemini-pro accepts 30,720 input tokens. Reference material is capped well below that so the
+# instructions, the draft carried in the chat history, and the expansion turns still fit.
+REFERENCE_TOKEN_BUDGET = 16000
+REFERENCE_PASSAGE_CHARS = 2000 # Approximate size of the passages selected from oversized material
+REFERENCE_TOKEN_COUNTS = {} # Token counts of reference material, keyed by its SHA-256
+_TERM_RE = re.compile(r"\w+")
+
+def split_into_passages(text, max_chars=REFERENCE_PASSAGE_CHARS):
+    """Splits text into passages of up to max_chars characters at paragraph or sentence boundaries."""
+    passages = []
+    current, current_chars = [], 0
+    for paragraph in re.split(r"\n\s*\n", text):
+        # Paragraphs longer than a passage are broken up at sentence boundaries
+        pieces = [paragraph] if len(paragraph) <= max_chars else re.split(r"(?<=[.!?])\s+", paragraph)
+        for piece_index, piece in enumerate(pieces):
+            # Sentences of one paragraph stay in the same paragraph; paragraphs are separated by a blank line
+            separator = "" if not current else (" " if piece_index > 0 else "\n\n")
+            if current and current_chars + len(separator) + len(piece) > max_chars:
+                passages.append("".join(current))
+                current, current_chars, separator = [], 0, ""
+            current.extend([separator, piece])
+            current_chars += len(separator) + len(piece)
+    if current:
+        passages.append("".join(current))
+    return passages
+
+def rank_passages(passages, query):
+    """Returns passage indices ordered by TF-IDF cosine similarity to the query, most relevant first."""
+    passage_terms = [Counter(_TERM_RE.findall(passage.lower())) for passage in passages]
+    document_frequency = Counter(term for terms in passage_terms for term in terms)
+    idf = {term: math.log((1 + len(passages)) / (1 + df)) + 1 for term, df in document_frequency.items()}
+    query_weights = {term: count * idf.get(term, 0.0) for term, count in Counter(_TERM_RE.findall(query.lower())).items()}
+
+    scores = []
+    for terms in passage_terms:
+        weights = {term: count * idf[term] for term, count in terms.items()}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+        dot = sum(weight * weights.get(term, 0.0) for term, weight in query_weights.items())
+        scores.append(dot / norm if norm else 0.0) # The query norm is the same for every passage
+    return sorted(range(len(passages)), key=lambda index: scores[index], reverse=True)
+
+def fit_reference_material(reference_material, topic):
+    """
+    Returns the reference material unchanged if it fits REFERENCE_TOKEN_BUDGET; otherwise returns
+    the passages most relevant to the topic that fit, in their original order.
+    """
+    if not reference_material:
+        return reference_material
+
+    # Tokenize the material once; repeated generations with the same material reuse the count
+    reference_hash = compute_file_hash(reference_material.encode("utf-8"))
+    total_tokens = REFERENCE_TOKEN_COUNTS.get(reference_hash)
+    if total_tokens is None:
+        try:
+            total_tokens = model.count_tokens(reference_material).total_tokens
+        except Exception as e:
+            print(f"Could not count reference material tokens ({e}). Sending it unchanged.")
+            return reference_material
+        REFERENCE_TOKEN_COUNTS[reference_hash] = total_tokens
+    if total_tokens <= REFERENCE_TOKEN_BUDGET:
+        return reference_material
+
+    # Estimate passage sizes from the measured characters-per-token ratio rather than
+    # making one count_tokens request per passage
+    chars_per_token = len(reference_material) / total_tokens
+    passages = split_into_passages(reference_material)
+    selected, used_tokens = [], 0
+    for index in rank_passages(passages, topic):
+        passage_tokens = len(passages[index]) / chars_per_token
+        if used_tokens + passage_tokens <= REFERENCE_TOKEN_BUDGET:
+            selected.append(index)
+            used_tokens += passage_tokens
+
+    print(f"Reference material is {total_tokens} tokens, over the {REFERENCE_TOKEN_BUDGET}-token budget. "
+          f"Using the {len(selected)} of {len(passages)} passages most relevant to the topic.")
+    return "\n\n".join(passages[index] for index in sorted(selected))
+
+# Title of a closing section ("Conclusion", "In Conclusion", "Final Thoughts", ...), optionally numbered.
+_CLOSING_TITLE = r"(?:\d+[.)][ \t]*)?(?:in[ \t]+)?(?:conclusions?|final[ \t]+thoughts|closing[ \t]+thoughts|summary|wrapping[ \t]+up)\b"
+# A heading line with a closing title: a Markdown heading, or a line that is bold and nothing else.
+# Anchored to the start of the title so body sections such as "Drawing Conclusions from Data" do not match,
+# and bold lead-ins such as "**In conclusion**, ..." inside a paragraph are not mistaken for headings.
+_CONCLUSION_HEADING_RE = re.compile(
+    rf"^(?:#+[ \t]*{_CLOSING_TITLE}[^\n]*|\*\*[ \t]*{_CLOSING_TITLE}[^\n*]*\*\*[ \t]*)$",
+    flags=re.IGNORECASE | re.MULTILINE,
+)
+# Only headings in the last part of the article count, so an opening "Summary" is not treated as the ending
+CONCLUSION_SEARCH_FRACTION = 0.5
+
+def insert_before_conclusion(article, new_sections):
+    """Inserts expansion sections before the article's concluding section, or appends them if there is none."""
+    # The first closing-style heading in the last part of the article starts the concluding section
+    conclusion = _CONCLUSION_HEADING_RE.search(article, int(len(article) * CONCLUSION_SEARCH_FRACTION))
+    if conclusion is None:
+        return f"{article.rstrip()}\n\n{new_sections.strip()}\n"
+    return f"{article[:conclusion.start()].rstrip()}\n\n{new_sections.strip()}\n\n{article[conclusion.start():]}"
+
+def is_auth_error(error):
+    """Returns True if a Gemini API error was caused by an invalid or unauthorized API key."""
+    if isinstance(error, (google_exceptions.Unauthenticated, google_exceptions.PermissionDenied)):
+        return True
+    # The Gemini API reports malformed or revoked keys as 400 INVALID_ARGUMENT
+    return isinstance(error, google_exceptions.InvalidArgument) and "API key" in str(error)
+
+async def generate_candidates_concurrently(prompt, generation_config, count):
+    """Issues several single-candidate requests concurrently and returns their responses."""
+    return await asyncio.gather(*[
+        model.generate_content_async(prompt, generation_config=generation_config)
+        for _ in range(count)
+    ])
+
+def generate_candidates(prompt, generation_settings, candidate_count=1, chat=None):
+    """
+    Generates one or more drafts for the prompt in a single round-trip, as a new turn of `chat` if given.
+    Returns the candidate texts and the prompt feedback of the response.
+    """
+    generation_config = genai.GenerationConfig(**generation_settings, candidate_count=candidate_count)
+    try:
+        if chat is not None:
+            response_iter = chat.send_message(prompt, generation_config=generation_config, stream=True)
+        else:
+            response_iter = model.generate_content(prompt, generation_config=generation_config, stream=True)
+        return stream_candidates(response_iter), response_iter.prompt_feedback
+    except google_exceptions.InvalidArgument as e:
+        if candidate_count == 1 or is_auth_error(e):
+            raise
+        # Some models reject candidate_count > 1; run the same prompt concurrently instead.
+        print(f"Model does not support multiple candidates. Sending {candidate_count} concurrent requests instead...")
+        single_config = genai.GenerationConfig(**generation_settings, candidate_count=1)
+        responses = asyncio.get_event_loop().run_until_complete(
+            generate_candidates_concurrently(prompt, single_config, candidate_count)
+        )
+        texts = []
+        for response in responses:
+            try:
+                texts.append(response.text)
+            except ValueError:
+                texts.append("") # Blocked or empty candidate
+        return texts, responses[0].prompt_feedback
 
 def generate_article(topic, tone, style, reference_material, min_word_count=1800, max_attempts=3):
     """
     Generates a long-form article using the Google Gemini API, with iterative expansion
     to meet a minimum word count.
+    Returns (article, complete), where complete is True only if the article reached min_word_count.
     """
     if model is None:
-        return "Error: Gemini model not initialized. Please check API key setup in Step 2."
+        return "Error: Gemini model not initialized. Please check API key setup in Step 2.", False
 
     current_article = ""
+    word_count = 0 # Word count of current_article, recomputed only when the article changes
     attempt = 0
     
-    # Generation configuration for the model.
-    # max_output_tokens is crucial for longer responses. 8192 is a common max for Gemini Pro.
-    # Temperature controls creativity (higher = more creative).
-    generation_config = genai.GenerationConfig(
-        temperature=0.7,
-        top_p=0.95,
-        top_k=40,
-        max_output_tokens=8192, # Maximum tokens for the model's output
-    )
+    # Keep oversized reference material within the model's context window
+    reference_material = fit_reference_material(reference_material, topic)
+
+    # Chat session seeded with the first draft; expansion attempts are sent as follow-up turns
+    chat = None
 
     # Loop to iteratively generate and expand the article until min_word_count is met
-    while count_words(current_article) < min_word_count and attempt < max_attempts:
+    while word_count < min_word_count and attempt < max_attempts:
         attempt += 1
         print(f"\n--- Generation Attempt {attempt}/{max_attempts} ---")
 
-        prompt_parts = []
-        # Include reference material if available
-        if reference_material:
-            prompt_parts.append(f"Refer to the following background information and incorporate relevant details naturally:\n\nReference Material:\n{reference_material}\n\n")
-
         if attempt == 1:
+            prompt_parts = []
+            # Include reference material if available
+            if reference_material:
+                prompt_parts.append(f"Refer to the following background information and incorporate relevant details naturally:\n\nReference Material:\n{reference_material}\n\n")
+
             # Initial prompt for the first generation attempt
             prompt_parts.append(f"""
             Write a detailed and comprehensive long-form article on the topic of "{topic}".
             The article should be written in a {tone} tone and a {style} style.
-            It must be at least {min_word_count} words long.
+            Target approximately {int(min_word_count * TARGET_LENGTH_FACTOR)} words (minimum {min_word_count}).
             Ensure the article is well-structured with an introduction, multiple body paragraphs, and a strong conclusion.
             Break down complex ideas, provide specific examples, and maintain coherence throughout.
             Focus on delivering a high-quality, in-depth analysis of the topic.
             """)
+            prompt = "\n".join(prompt_parts).strip()
         else:
-            # Expansion prompt for subsequent attempts if the article is too short
-            print(f"Current article word count: {count_words(current_article)}. Expanding to reach {min_word_count} words.")
-            prompt_parts.append(f"""
-            The following article on "{topic}" is currently {count_words(current_article)} words long.
-            Please expand upon it to reach a total length of at least {min_word_count} words.
-            Focus on adding more detail, deeper analysis, additional examples, or further relevant sub-sections to the existing content.
+            # Expansion prompt for subsequent attempts if the article is too short.
+            # The draft is already in the chat history, so the prompt only carries the new instruction
+            # and the model returns just the added sections instead of re-emitting the whole article.
+            print(f"Current article word count: {word_count}. Expanding to reach {min_word_count} words.")
+            prompt = f"""
+            The article above is currently {word_count} words long.
+            Write about {min_word_count - word_count} more words of NEW body sections, each with its own heading, so the article reaches at least {min_word_count} words.
+            Focus on adding more detail, deeper analysis, additional examples, or further relevant sub-topics not yet covered.
             Maintain the original {tone} tone and {style} style.
-            Do NOT rewrite the entire article from scratch. Just expand and elaborate on the existing content to meet the length requirement while improving depth and clarity.
-
-            Existing Article to expand:
-            {current_article}
-            """)
-        
-        full_prompt = "\n".join(prompt_parts).strip()
+            Return ONLY the new sections. Do NOT repeat, rewrite, or summarize the existing article, and do not write another conclusion.
+            """.strip()
         
         try:
             print("Sending request to Gemini API...")
             # The context window for gemini-pro is 30,720 tokens, which should accommodate
             # both the prompt (including reference material and existing article) and the desired output.
-            response = model.generate_content(full_prompt, generation_config=generation_config)
+            # Stream the response so the article appears as it is written instead of after the full completion.
+            # The first attempt asks for several drafts in one call and keeps the longest, so a short
+            # first draft rarely costs another full round-trip.
+            if attempt == 1:
+                candidate_count = FIRST_ATTEMPT_CANDIDATES
+                attempt_settings = GENERATION_SETTINGS
+            else:
+                # Expansions only return the missing sections, so cap the output at roughly
+                # two tokens per missing word (8192 remains the ceiling).
+                candidate_count = 1
+                missing_words = min_word_count - word_count
+                attempt_settings = dict(GENERATION_SETTINGS, max_output_tokens=min(8192, 1024 + 2 * missing_words))
+            candidates, prompt_feedback = generate_candidates(prompt, attempt_settings, candidate_count, chat=chat)
+            response_text = max(candidates, key=count_words, default="")
             
             # Check if the response contains text content
-            if response.text:
-                current_article = response.text # The model is asked to return the *expanded* full article
-                print(f"Generated text length: {count_words(current_article)} words.")
-                if count_words(current_article) < min_word_count:
+            if response_text:
+                if chat is None:
+                    current_article = response_text
+                    chat = model.start_chat(history=[
+                        {"role": "user", "parts": [prompt]},
+                        {"role": "model", "parts": [current_article]},
+                    ])
+                else:
+                    # Expansion attempts only return the new sections
+                    current_article = insert_before_conclusion(current_article, response_text)
+                word_count = count_words(current_article)
+                save_text_atomically(ARTICLE_PATH, current_article) # Keep the latest draft safe on disk
+                print(f"Generated text length: {word_count} words.")
+                if word_count < min_word_count:
                     print("Article is still too short. Attempting to expand further...")
                 else:
                     print("Target word count reached or exceeded.")
+                    break # No further round-trips needed
             else:
                 # Handle cases where the API returns an empty response (e.g., due to safety filters)
                 print("Gemini API returned an empty response. This might be due to safety filters or an internal error.")
-                if response.prompt_feedback and response.prompt_feedback.block_reason:
-                    print(f"Blocked Reason: {response.prompt_feedback.block_reason}")
+                if prompt_feedback and prompt_feedback.block_reason:
+                    print(f"Blocked Reason: {prompt_feedback.block_reason}")
                     print("Please try adjusting your topic or content to avoid sensitive subjects.")
                 current_article = "ERROR: Could not generate content. Please try adjusting your prompt or inputs."
                 break # Exit loop on empty or blocked response
 
         except Exception as e:
+            if is_auth_error(e):
+                print(f"The Gemini API rejected the API key: {e}")
+                print("Please check your key in STEP 2 and ensure it has access to 'gemini-pro'.")
+                current_article = "ERROR: Failed to generate article because the API key was rejected. Please check STEP 2 (API Key Setup)."
+                break # Retrying with the same key cannot succeed
             # Catch any other API related errors (e.g., network issues, invalid request)
             print(f"An error occurred during API call: {e}")
             current_article = "ERROR: Failed to generate article due to API error. Please check your inputs and API key."
             break # Exit loop on API error
 
     # Final check and message after all attempts
-    if count_words(current_article) < min_word_count:
+    word_count = count_words(current_article) # The article may have been replaced by an error message
+    complete = word_count >= min_word_count
+    if not complete:
         print(f"\nWarning: Could not reach the target word count of {min_word_count} words after {max_attempts} attempts.")
-        print(f"Final article length: {count_words(current_article)} words.")
+        print(f"Final article length: {word_count} words.")
         print("You may try increasing 'max_attempts' (in the code), adjusting the prompt, or providing more detailed reference material.")
     else:
-        print(f"\nArticle generation complete! Final word count: {count_words(current_article)} words.")
+        print(f"\nArticle generation complete! Final word count: {word_count} words.")
     
-    return current_article
+    return current_article, complete
+
+# Number of sections (including introduction and conclusion) in the outline used for parallel generation
+OUTLINE_SECTION_COUNT = 6
+
+def generate_outline(topic, tone, style, section_count=OUTLINE_SECTION_COUNT):
+    """
+    Asks the model for an article outline. Returns the title and the list of section headings,
+    or (None, []) if the response contained no usable outline.
+    """
+    prompt = f"""
+    Create an outline for a long-form article on the topic of "{topic}", written in a {tone} tone and a {style} style.
+    Return the article title on the first line, followed by exactly {section_count} section headings, one per line.
+    The first section must be an introduction and the last a conclusion.
+    Return only the title and headings, without numbering, bullets, or any other text.
+    """.strip()
+    response = model.generate_content(prompt, generation_config=genai.GenerationConfig(**dict(GENERATION_SETTINGS, max_output_tokens=512)))
+    try:
+        outline_text = response.text
+    except ValueError:
+        outline_text = "" # The response was empty or blocked
+    lines = [line.strip().strip("#*-. ").strip() for line in outline_text.splitlines()]
+    lines = [line for line in lines if line]
+    if len(lines) < 2:
+        return None, [] # Blank or title-only outline
+    return lines[0], lines[1:]
+
+async def generate_sections_concurrently(section_prompts, generation_config):
+    """Generates every section concurrently and returns the responses in outline order."""
+    return await asyncio.gather(*[
+        model.generate_content_async(section_prompt, generation_config=generation_config)
+        for section_prompt in section_prompts
+    ])
+
+def generate_article_by_sections(topic, tone, style, reference_material, min_word_count=1800):
+    """
+    Generates a long-form article by outlining it with one small request and then writing
+    all sections in parallel, so the wait is set by the longest section rather than the whole article.
+    Returns (article, complete), like generate_article.
+    """
+    if model is None:
+        return "Error: Gemini model not initialized. Please check API key setup in Step 2.", False
+
+    try:
+        print("Requesting article outline from Gemini API...")
+        title, headings = generate_outline(topic, tone, style)
+        if not headings:
+            print("Gemini did not return a usable outline. Generating the article iteratively instead...")
+            return generate_article(topic, tone, style, reference_material, min_word_count)
+        print(f"Outline: '{title}' with {len(headings)} sections.")
+
+        reference_material = fit_reference_material(reference_material, topic)
+
+        outline = "\n".join(f"- {heading}" for heading in headings)
+        words_per_section = math.ceil(min_word_count * TARGET_LENGTH_FACTOR / len(headings))
+        reference_prompt = ""
+        if reference_material:
+            reference_prompt = f"Refer to the following background information and incorporate relevant details naturally:\n\nReference Material:\n{reference_material}\n\n"
+        section_prompts = [f"""{reference_prompt}
+            You are writing one section of a long-form article titled "{title}" on the topic of "{topic}".
+            The full outline of the article is:
+            {outline}
+
+            Write ONLY the section "{heading}", about {words_per_section} words long, in a {tone} tone and a {style} style.
+            Start with the heading "## {heading}" and do not write any other section.
+            Provide specific examples and in-depth analysis, and avoid repeating what other sections of the outline will cover.
+            """.strip() for heading in headings]
+
+        print(f"Generating {len(section_prompts)} sections in parallel...")
+        responses = asyncio.get_event_loop().run_until_complete(
+            generate_sections_concurrently(section_prompts, genai.GenerationConfig(**GENERATION_SETTINGS))
+        )
+        sections = []
+        for heading, response in zip(headings, responses):
+            try:
+                sections.append(response.text)
+            except ValueError:
+                print(f"Section '{heading}' was empty or blocked and has been skipped.")
+    except Exception as e:
+        if is_auth_error(e):
+            print(f"The Gemini API rejected the API key: {e}")
+            print("Please check your key in STEP 2 and ensure it has access to 'gemini-pro'.")
+            return "ERROR: Failed to generate article because the API key was rejected. Please check STEP 2 (API Key Setup).", False
+        print(f"An error occurred during API call: {e}")
+        return "ERROR: Failed to generate article due to API error. Please check your inputs and API key.", False
+
+    article = f"# {title}\n\n" + "\n\n".join(section.strip() for section in sections)
+    save_text_atomically(ARTICLE_PATH, article)
+    word_count = count_words(article)
+    complete = word_count >= min_word_count
+    if not complete:
+        print(f"\nWarning: The sectioned article is {word_count} words, short of the {min_word_count}-word target.")
+        print("Try generating again without parallel sections to let the notebook expand the article iteratively.")
+    else:
+        print(f"\nArticle generation complete! Final word count: {word_count} words.")
+    return article, complete
 
 # Button to trigger article generation
 generate_button = widgets.Button(description="Generate Article")
 output_generation = widgets.Output() # Output widget for generation messages
+# Optional mode that writes all sections at once (faster, but sections are written independently)
+parallel_sections_checkbox = widgets.Checkbox(
+    value=False,
+    description='Generate sections in parallel (faster, less cohesive)',
+    layout=widgets.Layout(width='80%'),
+)
 
 def on_generate_clicked(b):
     """Callback function when the 'Generate Article' button is clicked."""
-    with output_generation:
-        clear_output() # Clear previous output
-        # Pre-flight checks
-        if not ARTICLE_TOPIC or not ARTICLE_TONE or not ARTICLE_STYLE:
-            print("Error: Please confirm article details in STEP 3 before generating.")
-            return
-        if model is None:
-            print("Error: Gemini API is not configured. Please check STEP 2 (API Key Setup).")
-            return
-
-        print("Starting article generation process...")
-        # Call the main article generation function
-        final_article_text = generate_article(
-            topic=ARTICLE_TOPIC,
-            tone=ARTICLE_TONE,
-            style=ARTICLE_STYLE,
-            reference_material=REFERENCE_MATERIAL
-        )
-        global GENERATED_ARTICLE
-        GENERATED_ARTICLE = final_article_text # Store the result globally
-        print("\n--- Generation Process Completed ---")
-        print("The generated article is ready for display in the next step.")
+    # Disable the button while this runs so repeated clicks cannot start overlapping runs
+    b.disabled = True
+    b.description = "Generating..."
+    try:
+        with output_generation:
+            clear_output() # Clear previous output
+            # Pre-flight checks
+            if not ARTICLE_TOPIC or not ARTICLE_TONE or not ARTICLE_STYLE:
+                print("Error: Please confirm article details in STEP 3 before generating.")
+                return
+            if model is None:
+                print("Error: Gemini API is not configured. Please check STEP 2 (API Key Setup).")
+                return
+
+            # Identical inputs reuse the article saved by an earlier run instead of calling the API again
+            mode = "sections" if parallel_sections_checkbox.value else "iterative"
+            cache_path = article_cache_path(ARTICLE_TOPIC, ARTICLE_TONE, ARTICLE_STYLE, REFERENCE_MATERIAL, mode)
+            if os.path.exists(cache_path):
+                print("An article was already generated from these exact inputs. Reusing the saved article.")
+                print(f"(Delete '{ARTICLE_CACHE_DIR}' to force a fresh generation.)")
+                with open(cache_path, encoding="utf-8") as f:
+                    final_article_text = f.read()
+            else:
+                print("Starting article generation process...")
+                # Call the main article generation function
+                generate = generate_article_by_sections if mode == "sections" else generate_article
+                final_article_text, article_complete = generate(
+                    topic=ARTICLE_TOPIC,
+                    tone=ARTICLE_TONE,
+                    style=ARTICLE_STYLE,
+                    reference_material=REFERENCE_MATERIAL
+                )
+                # Only articles that reached the target are reused; short or failed runs can be retried
+                if article_complete:
+                    save_text_atomically(cache_path, final_article_text)
+            global GENERATED_ARTICLE
+            GENERATED_ARTICLE = final_article_text # Store the result globally
+            print("\n--- Generation Process Completed ---")
+            print("The generated article is ready for display in the next step.")
+            if not final_article_text.upper().startswith("ERROR"):
+                # Only offer the download if the final article actually reached the disk
+                if save_text_atomically(ARTICLE_PATH, final_article_text) and os.path.exists(ARTICLE_PATH):
+                    print(f"A copy has been saved to '{ARTICLE_PATH}' and is being downloaded.")
+                    files.download(ARTICLE_PATH)
+                else:
+                    print("The article could not be saved to disk, so no download is offered. It is still available for STEP 6.")
+    finally:
+        b.disabled = False
+        b.description = "Generate Article"
 
 # Attach the callback function to the button's click event
 generate_button.on_click(on_generate_clicked)
-display(generate_button, output_generation) # Display the button and its output area
+display(parallel_sections_checkbox, generate_button, output_generation) # Display the controls and their output area
 
 # @title ## STEP 6: Display Generated Article
 
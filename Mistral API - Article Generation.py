@@ -13,14 +13,18 @@
 # We need `requests` to interact with the Mistral API directly via HTTP.
 # `ipywidgets` and `IPython.display` are for creating interactive user inputs and displaying rich content.
 # `google.colab.files` is for file uploads.
-# `PyPDF2` for robust PDF document processing.
+# `PyMuPDF` (imported as `fitz`) for fast PDF text extraction, or `pypdfium2` as a permissively licensed alternative.
+# `numpy` for comparing embeddings in the generated-article cache and when selecting reference documents.
+# `tiktoken` for estimating how many tokens the reference material adds to the prompt.
+# `ipywidgets` and the PDF libraries are only imported in the steps that first use them, which keeps this
+# cell fast and the notebook's memory footprint small.
 
 import sys
 
 print("Installing required packages...")
 try:
     # Suppress installation output for cleaner notebook
-    !{sys.executable} -m pip install requests ipywidgets PyPDF2 --quiet
+    !{sys.executable} -m pip install requests ipywidgets pymupdf pypdfium2 numpy tiktoken --quiet
     print("Packages installed successfully.")
 except Exception as e:
     print(f"Error installing packages: {e}")
@@ -30,12 +34,24 @@ except Exception as e:
 
 # Import necessary libraries after installation
 import requests
-import ipywidgets as widgets
-from IPython.display import display, Markdown, HTML, clear_output
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry # For retrying transient API errors with backoff
+from charset_normalizer import from_bytes # Text encoding detection (installed as a dependency of requests)
+from IPython.display import display, Markdown, clear_output
 from google.colab import userdata, files
-import PyPDF2
-import io # For handling binary data from file uploads
 import json # For handling JSON responses from API
+import re
+import os
+import gc
+import time
+import asyncio # For extracting uploaded files in the background without blocking the notebook
+import hashlib # For content-hash caching of extracted reference text
+import tempfile
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor # For extracting PDF pages on all CPU cores
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import ThreadPoolExecutor # For processing uploaded files concurrently
 
 # Define the Mistral API endpoint and default model
 MISTRAL_API_BASE_URL = "https://api.mistral.ai/v1"
@@ -59,6 +75,25 @@ MISTRAL_MODEL = "mistral-medium-latest" # You can change this to "mistral-large-
 
 MISTRAL_API_KEY = None
 
+# Reuse one HTTP session for every Mistral request so the TLS connection to the API is kept alive
+# between calls. Rate-limit (429) and transient 5xx responses are retried with exponential backoff.
+mistral_session = requests.Session()
+mistral_session.headers.update({
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+})
+mistral_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None, # Also retry POST; these statuses mean the request was not processed
+        raise_on_status=False, # Hand the final error response back so raise_for_status() reports it
+    ),
+))
+
 try:
     # Attempt to retrieve API key from Colab secrets
     MISTRAL_API_KEY = userdata.get('MISTRAL_API_KEY')
@@ -70,25 +105,17 @@ try:
             raise ValueError("Mistral API Key cannot be empty.")
     
     print("Mistral API Key loaded successfully.")
+    mistral_session.headers["Authorization"] = f"Bearer {MISTRAL_API_KEY}"
 
-    # Test a small model call to ensure authentication works
+    # Check that authentication works by listing the available models.
+    # Unlike a test chat completion, this is fast and does not consume completion quota.
     try:
-        test_url = f"{MISTRAL_API_BASE_URL}/chat/completions"
-        test_headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Bearer {MISTRAL_API_KEY}"
-        }
-        test_data = {
-            "model": MISTRAL_MODEL,
-            "messages": [{"role": "user", "content": "Hello"}],
-            "max_tokens": 10
-        }
+        test_url = f"{MISTRAL_API_BASE_URL}/models"
         
-        response = requests.post(test_url, headers=test_headers, json=test_data)
+        response = mistral_session.get(test_url, timeout=(5, 30)) # (connect, read) timeouts
         response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
         
-        if response.json().get('choices'):
+        if response.json().get('data'):
             print("API key validated: Connection to Mistral API successful.")
         else:
             print("API key validation failed: Empty response or unexpected format.")
@@ -121,6 +148,8 @@ except Exception as e:
 
 # @markdown Use the interactive widgets below to define the core aspects of your article.
 
+import ipywidgets as widgets
+
 # Initialize global variables for article details. These will store user inputs.
 ARTICLE_TOPIC = None
 ARTICLE_TONE = None
@@ -185,25 +214,32 @@ output_details = widgets.Output() # Output widget to show messages
 
 def on_confirm_details_clicked(b):
     """Callback function when the 'Confirm Article Details' button is clicked."""
-    with output_details:
-        clear_output() # Clear previous output in this section
-        global ARTICLE_TOPIC, ARTICLE_TONE, ARTICLE_ATTITUDE, ARTICLE_STYLE
-        ARTICLE_TOPIC = topic_input.value.strip()
-        ARTICLE_TONE = tone_input.value
-        ARTICLE_ATTITUDE = attitude_input.value
-        ARTICLE_STYLE = style_input.value
-
-        # Validate that the topic is not empty
-        if not ARTICLE_TOPIC:
-            print("Error: Article Topic cannot be empty. Please provide a topic.")
-            ARTICLE_TOPIC = None
-            return
-
-        print(f"Article Topic: '{ARTICLE_TOPIC}'")
-        print(f"Article Tone: '{ARTICLE_TONE}'")
-        print(f"Article Attitude: '{ARTICLE_ATTITUDE}'")
-        print(f"Article Style: '{ARTICLE_STYLE}'")
-        print("\nArticle details confirmed. You can now proceed to upload reference documents (optional).")
+    # Disable the button while this runs so repeated clicks cannot start overlapping runs
+    b.disabled = True
+    b.description = "Confirming..."
+    try:
+        with output_details:
+            clear_output() # Clear previous output in this section
+            global ARTICLE_TOPIC, ARTICLE_TONE, ARTICLE_ATTITUDE, ARTICLE_STYLE
+            ARTICLE_TOPIC = topic_input.value.strip()
+            ARTICLE_TONE = tone_input.value
+            ARTICLE_ATTITUDE = attitude_input.value
+            ARTICLE_STYLE = style_input.value
+
+            # Validate that the topic is not empty
+            if not ARTICLE_TOPIC:
+                print("Error: Article Topic cannot be empty. Please provide a topic.")
+                ARTICLE_TOPIC = None
+                return
+
+            print(f"Article Topic: '{ARTICLE_TOPIC}'")
+            print(f"Article Tone: '{ARTICLE_TONE}'")
+            print(f"Article Attitude: '{ARTICLE_ATTITUDE}'")
+            print(f"Article Style: '{ARTICLE_STYLE}'")
+            print("\nArticle details confirmed. You can now proceed to upload reference documents (optional).")
+    finally:
+        b.disabled = False
+        b.description = "Confirm Article Details"
 
 # Attach the callback function to the button's click event
 confirm_button.on_click(on_confirm_details_clicked)
@@ -220,82 +256,284 @@ display(confirm_button, output_details) # Display the button and its output area
 REFERENCE_MATERIAL = ""
 
 def read_text_file(uploaded_file_content):
-    """Reads content from a text-based file (e.g., .txt, .md) with UTF-8 and Latin-1 fallback."""
+    """Reads content from a text-based file (e.g., .txt, .md), detecting its encoding if it is not UTF-8."""
     try:
-        return uploaded_file_content.decode('utf-8')
+        return uploaded_file_content.decode('utf-8') # Fast path for the common case
     except UnicodeDecodeError:
+        pass
+    try:
+        # Detect the actual encoding (UTF-16, CP-1252, ...) instead of assuming Latin-1,
+        # which turns such files into garbage that wastes prompt tokens
+        best_match = from_bytes(uploaded_file_content).best()
+        if best_match is not None:
+            return str(best_match)
+    except Exception as e:
+        print(f"Could not detect text file encoding: {e}")
+    # No confident match: Latin-1 maps every byte, so it always decodes
+    return uploaded_file_content.decode('latin-1', errors='replace')
+
+# PDF library used for text extraction. PyMuPDF is the fastest but AGPL-licensed;
+# pypdfium2 (Apache/BSD) is a fast, permissively licensed alternative.
+PDF_BACKEND = "pymupdf" # @param ["pymupdf", "pypdfium2"]
+PDF_MAX_WORKERS = 8 # Upper bound on worker processes used for PDF extraction
+PDF_WORKERS = min(PDF_MAX_WORKERS, os.cpu_count() or 1)
+
+# Neither MuPDF nor PDFium is thread-safe, so both only ever run in worker processes. All uploads share
+# one process pool, which lets several PDFs (and the pages of a large PDF) be extracted at the same time.
+_PDF_POOL = None
+_PDF_POOL_LOCK = threading.Lock()
+
+def get_pdf_pool():
+    """Returns the process pool shared by all PDF extractions, creating it on first use."""
+    global _PDF_POOL
+    with _PDF_POOL_LOCK:
+        if _PDF_POOL is None:
+            _PDF_POOL = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("fork"))
+        return _PDF_POOL
+
+def count_pdf_pages(pdf_path, backend):
+    """Returns the number of pages of a PDF. Runs in a worker process."""
+    if backend == "pypdfium2":
+        import pypdfium2 as pdfium
+        pdf = pdfium.PdfDocument(pdf_path)
         try:
-            return uploaded_file_content.decode('latin-1') # Fallback for other encodings
-        except Exception as e:
-            print(f"Could not decode text file: {e}")
-            return None
+            return len(pdf)
+        finally:
+            pdf.close()
+    import fitz # PyMuPDF, imported on first use
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+def extract_pdf_pages(pdf_path, backend, start, stop):
+    """Extracts the text of pages [start, stop) of a PDF. Runs in a worker process."""
+    if backend == "pypdfium2":
+        import pypdfium2 as pdfium
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            page_texts = []
+            for page_index in range(start, stop):
+                page = pdf[page_index]
+                # A text page collects only the page's characters, so vector graphics and images are never rendered
+                textpage = page.get_textpage()
+                page_texts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+            return page_texts
+        finally:
+            pdf.close()
+
+    import fitz # PyMuPDF, imported on first use
+    # PyMuPDF extracts text with MuPDF's C parser, which is much faster than pure-Python PDF libraries.
+    # The "text" mode only collects characters: drawings are ignored and images are not decoded,
+    # so graphics-heavy pages stay cheap.
+    with fitz.open(pdf_path) as doc:
+        return [doc[page_num].get_text("text") for page_num in range(start, stop)]
 
 def read_pdf_file(uploaded_file_content):
-    """Reads content from a PDF file using PyPDF2."""
+    """Reads content from a PDF file using the configured PDF_BACKEND."""
+    global _PDF_POOL
     try:
-        # PyPDF2 expects a file-like object, so we use io.BytesIO
-        pdf_file = io.BytesIO(uploaded_file_content)
-        reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        # Iterate through all pages and extract text
-        for page_num in range(len(reader.pages)):
-            page = reader.pages[page_num]
-            text += page.extract_text() + "\n" # Add a newline between page contents
-        return text
+        # Workers open the PDF from a temporary file, so tasks only carry its path
+        # instead of each pickling its own copy of the bytes
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(uploaded_file_content)
+            pool = get_pdf_pool()
+            page_count = pool.submit(count_pdf_pages, pdf_path, PDF_BACKEND).result()
+            step = max(-(-page_count // PDF_WORKERS), 1) # Ceiling division so every page is covered
+            futures = [pool.submit(extract_pdf_pages, pdf_path, PDF_BACKEND, start, min(start + step, page_count))
+                       for start in range(0, page_count, step)]
+            return "\n".join(text for future in futures for text in future.result())
+        finally:
+            os.remove(pdf_path)
     except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            _PDF_POOL = None # A worker died; start a fresh pool for the next PDF
         print(f"Error reading PDF file: {e}")
         return None
 
+# Text extractor for each supported file extension. Support for a new format only needs an entry here.
+FILE_READERS = {
+    'txt': read_text_file,
+    'md': read_text_file,
+    'pdf': read_pdf_file,
+}
+
+# Extracted text is cached by a hash of the file's bytes, so re-uploading the same references
+# (e.g. while iterating on tone or style) skips re-parsing them. The in-memory dict serves repeat
+# uploads within a session; the files on disk survive a kernel restart.
+EXTRACT_CACHE_DIR = "/content/.pdf_cache"
+EXTRACT_CACHE = {}
+
+def save_text_atomically(path, text):
+    """
+    Writes text to path through a temporary file and os.replace, so an interrupted write never
+    leaves a truncated file behind. Returns True on success.
+    """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        return True
+    except OSError as e:
+        print(f"Could not save '{path}': {e}")
+        return False
+
+def _cached_extract(content, read_file):
+    """
+    Returns (extracted_text, from_cache) for a file's bytes, extracting the text with read_file
+    unless identical content was extracted before.
+    """
+    content_hash = hashlib.blake2b(content, digest_size=16).hexdigest()
+    if content_hash in EXTRACT_CACHE:
+        return EXTRACT_CACHE[content_hash], True
+
+    cache_path = os.path.join(EXTRACT_CACHE_DIR, f"{content_hash}.txt")
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                extracted_text = f.read()
+            EXTRACT_CACHE[content_hash] = extracted_text
+            return extracted_text, True
+        except OSError:
+            pass # Unreadable cache entry; extract again below
+
+    extracted_text = read_file(content)
+    if extracted_text: # Failed extractions are not cached, so they are retried on the next upload
+        EXTRACT_CACHE[content_hash] = extracted_text
+        save_text_atomically(cache_path, extracted_text)
+    return extracted_text, False
+
+def process_uploaded_file(filename, content):
+    """
+    Extracts the text of one uploaded file.
+    Returns a (filename, extracted_text, status_message) tuple. Runs in a worker thread.
+    """
+    file_extension = os.path.splitext(filename)[1][1:].lower() # Get file extension without the dot
+    read_file = FILE_READERS.get(file_extension)
+    if read_file is None:
+        supported = ", ".join(f".{extension}" for extension in FILE_READERS)
+        return filename, None, f"Skipping unsupported file type: '{filename}' (only {supported} are supported)."
+
+    extracted_text, from_cache = _cached_extract(content, read_file)
+    if not extracted_text:
+        return filename, None, f"Failed to extract text from '{filename}'. It might be empty or corrupted."
+    source = " (from cache)" if from_cache else ""
+    return filename, extracted_text, f"Successfully processed '{filename}'{source}. Content length: {len(extracted_text)} characters."
+
 upload_button = widgets.Button(description="Upload Reference Documents")
 output_upload = widgets.Output() # Output widget for upload messages
+# The running background extraction. asyncio only keeps weak references to tasks, so this
+# reference keeps the task alive until it finishes.
+_upload_task = None
 
-def on_upload_clicked(b):
-    """Callback function when the 'Upload Reference Documents' button is clicked."""
+async def _process_all(b, uploaded):
+    """
+    Extracts the text of the uploaded files in worker threads and combines it into REFERENCE_MATERIAL.
+    Runs as a background task, so the notebook stays responsive while large PDFs are parsed.
+    """
     global REFERENCE_MATERIAL
-    REFERENCE_MATERIAL = "" # Reset reference material for new uploads or to clear previous
-    with output_upload:
-        clear_output() # Clear previous output in this section
-        print("Please select your reference files to upload (txt, md, pdf):")
-        try:
-            # Use google.colab.files.upload() for the file picker
-            uploaded = files.upload()
-            
-            if not uploaded:
-                print("No files selected or uploaded.")
-                return
-
-            # Process each uploaded file
-            for filename, content in uploaded.items():
-                print(f"Processing '{filename}'...")
-                file_extension = filename.split('.')[-1].lower() # Get file extension
-                
-                extracted_text = None
-                if file_extension in ['txt', 'md']:
-                    extracted_text = read_text_file(content)
-                elif file_extension == 'pdf':
-                    extracted_text = read_pdf_file(content)
-                else:
-                    print(f"Skipping unsupported file type: '{filename}' (only .txt, .md, .pdf are supported).")
-                    continue
-                
+    loop = asyncio.get_running_loop()
+    try:
+        # Process the uploaded files concurrently, so text files are not held up
+        # behind slow PDFs and the wait approaches the slowest file instead of the sum of all files
+        with output_upload:
+            print(f"Processing {len(uploaded)} file(s)...")
+        filenames = list(uploaded)
+        extracted_texts = {}
+        with ThreadPoolExecutor(max_workers=min(len(uploaded), os.cpu_count() or 1)) as pool:
+            futures = []
+            for filename in filenames:
+                # Pop each file's bytes so that, once its task finishes, nothing keeps the raw upload alive
+                content = uploaded.pop(filename)
+                futures.append(loop.run_in_executor(pool, process_uploaded_file, filename, content))
+                del content
+            for future in asyncio.as_completed(futures):
+                filename, extracted_text, status_message = await future
+                # Output is captured only around each print, since other cells may run while this task waits
+                with output_upload:
+                    print(status_message) # Report each file as soon as it finishes
                 if extracted_text:
-                    # Append extracted text with clear delimiters for the LLM
-                    REFERENCE_MATERIAL += f"\n--- Start of Reference Document: {filename} ---\n"
-                    REFERENCE_MATERIAL += extracted_text
-                    REFERENCE_MATERIAL += f"\n--- End of Reference Document: {filename} ---\n"
-                    print(f"Successfully processed '{filename}'. Content length: {len(extracted_text)} characters.")
-                else:
-                    print(f"Failed to extract text from '{filename}'. It might be empty or corrupted.")
-            
+                    extracted_texts[filename] = extracted_text
+
+        # Combine in upload order so the reference material does not depend on completion order
+        reference_parts = []
+        for filename in filenames:
+            if filename in extracted_texts:
+                # Append extracted text with clear delimiters for the LLM, formatted as a single string per document
+                reference_parts.append(
+                    f"\n--- Start of Reference Document: {filename} ---\n"
+                    f"{extracted_texts[filename]}"
+                    f"\n--- End of Reference Document: {filename} ---\n"
+                )
+        # Join once rather than re-copying the growing string for every piece
+        REFERENCE_MATERIAL = "".join(reference_parts)
+        del futures, extracted_texts, reference_parts
+
+        with output_upload:
             if REFERENCE_MATERIAL:
                 print("\nAll selected reference documents processed. Content will be used for article generation.")
                 print(f"Total combined reference material length: {len(REFERENCE_MATERIAL)} characters.")
             else:
                 print("No usable reference material was uploaded or extracted.")
 
-        except Exception as e:
-            print(f"An error occurred during file upload or processing: {e}")
-            REFERENCE_MATERIAL = "" # Clear reference material if error occurs to prevent using partial data
+    except Exception as e:
+        with output_upload:
+            print(f"An error occurred during file processing: {e}")
+        REFERENCE_MATERIAL = "" # Clear reference material if error occurs to prevent using partial data
+    finally:
+        gc.collect() # Return the memory of the raw uploads and intermediate texts right away
+        b.disabled = False
+        b.description = "Upload Reference Documents"
+        b._running = False
+
+def _clear_upload_task(task):
+    """Drops the reference to a finished upload task."""
+    global _upload_task
+    if _upload_task is task:
+        _upload_task = None
+
+def on_upload_clicked(b):
+    """Callback function when the 'Upload Reference Documents' button is clicked."""
+    global REFERENCE_MATERIAL, _upload_task
+    if getattr(b, "_running", False):
+        return # Ignore clicks while an upload is still being picked or processed
+    b._running = True
+    # Disable the button while this runs so repeated clicks cannot start overlapping runs
+    b.disabled = True
+    b.description = "Uploading..."
+    processing_started = False
+    try:
+        REFERENCE_MATERIAL = "" # Reset reference material for new uploads or to clear previous
+        with output_upload:
+            clear_output() # Clear previous output in this section
+            print("Please select your reference files to upload (txt, md, pdf):")
+            try:
+                # Use google.colab.files.upload() for the file picker
+                uploaded = files.upload()
+                
+                if not uploaded:
+                    print("No files selected or uploaded.")
+                    return
+
+                # Extraction continues in the background; _process_all re-enables the button when it is done
+                b.description = "Processing..."
+                _upload_task = asyncio.ensure_future(_process_all(b, uploaded))
+                _upload_task.add_done_callback(_clear_upload_task)
+                processing_started = True
+
+            except Exception as e:
+                print(f"An error occurred during file upload: {e}")
+                REFERENCE_MATERIAL = "" # Clear reference material if error occurs to prevent using partial data
+    finally:
+        if not processing_started:
+            b.disabled = False
+            b.description = "Upload Reference Documents"
+            b._running = False
 
 # Attach the callback function to the button's click event
 upload_button.on_click(on_upload_clicked)
@@ -305,188 +543,491 @@ display(upload_button, output_upload) # Display the button and its output area
 
 # @markdown This step uses the Mistral API to generate the article based on your inputs and reference material. The process may take a few moments. The notebook will attempt to generate an article of at least 1800 words, iteratively expanding it if necessary.
 
+import numpy as np # For comparing request embeddings in the article cache
+
 # Global variable to store the final generated article
 GENERATED_ARTICLE = ""
+MIN_WORD_COUNT = 1800 # Target length of the generated article
+PREVIEW_REFRESH_SECONDS = 0.5 # Minimum time between redraws of the streamed preview
+# Output budget per request: about 1.7 tokens per requested word plus headroom for headings and
+# formatting, so one call can normally produce the whole article. Capped at the model's output limit.
+TOKENS_PER_WORD = 1.7
+MAX_OUTPUT_TOKENS = 32000
+
+# Matches one whitespace-delimited word
+_WORD_RE = re.compile(r"\S+")
 
 def count_words(text):
     """Helper function to count words in a string."""
     if not text:
         return 0
-    return len(text.split())
+    # Counting regex matches avoids building the list of substrings that text.split() allocates
+    return sum(1 for _ in _WORD_RE.finditer(text))
+
+# Title of a closing section ("Conclusion", "In Conclusion", "Final Thoughts", ...), optionally numbered.
+_CLOSING_TITLE = r"(?:\d+[.)][ \t]*)?(?:in[ \t]+)?(?:conclusions?|final[ \t]+thoughts|closing[ \t]+thoughts|summary|wrapping[ \t]+up)\b"
+# A heading line with a closing title: a Markdown heading, or a line that is bold and nothing else.
+# Anchored to the start of the title so body sections such as "Drawing Conclusions from Data" do not match,
+# and bold lead-ins such as "**In conclusion**, ..." inside a paragraph are not mistaken for headings.
+_CONCLUSION_HEADING_RE = re.compile(
+    rf"^(?:#+[ \t]*{_CLOSING_TITLE}[^\n]*|\*\*[ \t]*{_CLOSING_TITLE}[^\n*]*\*\*[ \t]*)$",
+    flags=re.IGNORECASE | re.MULTILINE,
+)
+# Only headings in the last part of the article count, so an opening "Summary" is not treated as the ending
+CONCLUSION_SEARCH_FRACTION = 0.5
+
+def insert_before_conclusion(article, new_sections):
+    """Inserts expansion sections before the article's concluding section, or appends them if there is none."""
+    # The first closing-style heading in the last part of the article starts the concluding section
+    conclusion = _CONCLUSION_HEADING_RE.search(article, int(len(article) * CONCLUSION_SEARCH_FRACTION))
+    if conclusion is None:
+        return f"{article.rstrip()}\n\n{new_sections.strip()}\n"
+    return f"{article[:conclusion.start()].rstrip()}\n\n{new_sections.strip()}\n\n{article[conclusion.start():]}"
 
 def call_mistral_api(messages, model=MISTRAL_MODEL, max_tokens=8192, temperature=0.7):
     """
     Helper function to make a call to the Mistral API.
+    Returns (content, finish_reason), or (None, None) if the call fails.
     """
     if not MISTRAL_API_KEY:
         print("Error: Mistral API key is not set.")
-        return None
+        return None, None
 
     url = f"{MISTRAL_API_BASE_URL}/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Authorization": f"Bearer {MISTRAL_API_KEY}"
-    }
     payload = {
         "model": model,
         "messages": messages,
         "max_tokens": max_tokens,
         "temperature": temperature,
-        "random_seed": 42 # For reproducibility, optional
+        "random_seed": 42, # For reproducibility, optional
+        "stream": True # Receive the completion incrementally as server-sent events
     }
 
+    response = None
+    event_data = None
+    finish_reason = None
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=300) # 5-minute timeout
+        # The shared session reuses the open connection; 5-second connect and 5-minute read timeouts
+        response = mistral_session.post(url, json=payload, timeout=(5, 300), stream=True)
         response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
-        response_json = response.json()
-        
-        if response_json and response_json.get('choices'):
-            # Return the content of the first message in choices
-            return response_json['choices'][0]['message']['content']
-        else:
-            print(f"Mistral API returned an empty or malformed response: {response_json}")
-            # Check for error details if available
-            if response_json.get('error'):
-                print(f"API Error Details: {response_json['error']}")
-            return None
+
+        # Each event is a line of the form `data: {...}`; the stream ends with `data: [DONE]`
+        content_parts = []
+        # A display handle lets us redraw the same output area instead of appending a new one per chunk
+        preview = display(Markdown("*Waiting for the first tokens...*"), display_id=True)
+        last_refresh = time.monotonic()
+        for line in response.iter_lines():
+            if not line.startswith(b"data: "):
+                continue # Skip keep-alive blank lines
+            event_data = line[len(b"data: "):]
+            if event_data == b"[DONE]":
+                break
+            chunk = json.loads(event_data)
+            if chunk.get('choices'):
+                content_parts.append(chunk['choices'][0]['delta'].get('content') or "")
+                # Set on the last chunk: "stop" when the model finished, "length" when max_tokens cut it off
+                finish_reason = chunk['choices'][0].get('finish_reason') or finish_reason
+                # Deltas are only a few tokens each, so the preview is redrawn at most every
+                # PREVIEW_REFRESH_SECONDS rather than re-rendering the whole text per delta
+                if time.monotonic() - last_refresh >= PREVIEW_REFRESH_SECONDS:
+                    partial_text = "".join(content_parts)
+                    preview.update(Markdown(partial_text + f"\n\n*... {count_words(partial_text)} words so far*"))
+                    last_refresh = time.monotonic()
+            elif chunk.get('error'):
+                print(f"API Error Details: {chunk['error']}")
+
+        preview.update(Markdown("*Response complete.*"))
+        content = "".join(content_parts)
+        if content:
+            return content, finish_reason
+        print("Mistral API returned an empty streamed response.")
+        return None, None
 
     except requests.exceptions.HTTPError as errh:
         print(f"HTTP Error: {errh} - Response: {response.text}")
-        return None
+        return None, None
     except requests.exceptions.ConnectionError as errc:
         print(f"Error Connecting: {errc}")
-        return None
+        return None, None
     except requests.exceptions.Timeout as errt:
         print(f"Timeout Error: {errt}")
-        return None
+        return None, None
     except requests.exceptions.RequestException as err:
         print(f"An unexpected error occurred: {err}")
-        return None
+        return None, None
     except json.JSONDecodeError as e:
-        print(f"JSON Decode Error: Could not parse response from Mistral API: {e}")
-        print(f"Raw response: {response.text}")
+        print(f"JSON Decode Error: Could not parse streamed response from Mistral API: {e}")
+        print(f"Raw event: {event_data!r}")
+        return None, None
+    finally:
+        if response is not None:
+            response.close() # Return the connection to the session's pool
+
+# Generated articles are cached on disk under a hash of the request, so regenerating with
+# unchanged inputs does not pay for another API call.
+ARTICLE_CACHE_DIR = "/content/articles_cache"
+# Requests whose topic embeds this close to an earlier request's topic (with exactly the same tone,
+# attitude, style and reference material) reuse that request's article. Only covers articles generated this session.
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_EMBEDDINGS = None # One normalized embedding per row, built up as articles are cached
+SEMANTIC_CACHE_ENTRIES = [] # (settings_key, cache_path) for each row of SEMANTIC_CACHE_EMBEDDINGS
+EMBEDDING_CACHE = {} # Text -> normalized embedding, so a request is only embedded once
+
+def embed_texts(texts):
+    """
+    Embeds a list of texts with the Mistral embeddings endpoint.
+    Returns a matrix with one normalized embedding per row, or None if the call fails.
+    """
+    try:
+        response = mistral_session.post(f"{MISTRAL_API_BASE_URL}/embeddings",
+                                        json={"model": "mistral-embed", "input": texts}, timeout=(5, 60))
+        response.raise_for_status()
+        embeddings = np.array([item['embedding'] for item in response.json()['data']], dtype=np.float32)
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        print(f"Could not compute embeddings: {e}")
+        return None
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+def article_cache_keys(topic, tone, attitude, style, reference_material, min_word_count):
+    """
+    Returns (request_key, settings_key): a hash of everything sent to the model, and a hash of
+    the parts that must match exactly for a request with a similar topic to reuse an article.
+    """
+    # Tone, attitude and style are categorical choices whose names embed almost identically,
+    # so they must match exactly; only the free-text topic is compared by embedding
+    settings_key = hashlib.blake2b(json.dumps({
+        "model": MISTRAL_MODEL,
+        "tone": tone,
+        "attitude": attitude,
+        "style": style,
+        "reference_material": reference_material,
+        "min_word_count": min_word_count,
+    }, sort_keys=True).encode("utf-8")).hexdigest()
+    request_key = hashlib.blake2b(json.dumps({
+        "topic": topic,
+        "settings_key": settings_key,
+    }, sort_keys=True).encode("utf-8")).hexdigest()
+    return request_key, settings_key
+
+def embed_texts_cached(texts):
+    """Like embed_texts, but only texts that have not been embedded before are sent to the API."""
+    missing = [text for text in dict.fromkeys(texts) if text not in EMBEDDING_CACHE]
+    if missing:
+        embeddings = embed_texts(missing)
+        if embeddings is None:
+            return None
+        EMBEDDING_CACHE.update(zip(missing, embeddings))
+    return np.array([EMBEDDING_CACHE[text] for text in texts])
+
+def embed_topic(topic):
+    """Returns the (memoized) normalized embedding of an article topic, or None."""
+    embeddings = embed_texts_cached([topic])
+    return None if embeddings is None else embeddings[0]
+
+def load_cached_article(topic, tone, attitude, style, reference_material, min_word_count):
+    """
+    Returns (article, cache_path) for a previously generated article for these inputs,
+    or (None, None) on a cache miss. Tries an exact match on the request hash first, then a request with a near-identical topic.
+    """
+    request_key, settings_key = article_cache_keys(topic, tone, attitude, style, reference_material, min_word_count)
+    cache_paths = [os.path.join(ARTICLE_CACHE_DIR, f"{request_key}.md")]
+
+    candidate_rows = [row for row, (entry_settings_key, _) in enumerate(SEMANTIC_CACHE_ENTRIES) if entry_settings_key == settings_key]
+    if candidate_rows:
+        query = embed_topic(topic)
+        if query is not None:
+            # Rows and query are normalized, so the dot product is the cosine similarity
+            similarities = SEMANTIC_CACHE_EMBEDDINGS[candidate_rows] @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] > SEMANTIC_CACHE_THRESHOLD:
+                cache_paths.append(SEMANTIC_CACHE_ENTRIES[candidate_rows[best]][1])
+
+    for cache_path in cache_paths:
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                return f.read(), cache_path
+        except OSError:
+            continue # Not cached (or no longer readable)
+    return None, None
+
+def store_cached_article(topic, tone, attitude, style, reference_material, min_word_count, article):
+    """
+    Saves a generated article to the cache and records its request for near-duplicate lookups.
+    Returns the cache file's path, or None if it could not be saved.
+    """
+    global SEMANTIC_CACHE_EMBEDDINGS
+    request_key, settings_key = article_cache_keys(topic, tone, attitude, style, reference_material, min_word_count)
+    cache_path = os.path.join(ARTICLE_CACHE_DIR, f"{request_key}.md")
+    if not save_text_atomically(cache_path, article):
         return None
 
+    embedding = embed_topic(topic)
+    if embedding is None:
+        return cache_path # The exact-match cache still works without an embedding
+    if SEMANTIC_CACHE_EMBEDDINGS is None:
+        SEMANTIC_CACHE_EMBEDDINGS = embedding[np.newaxis, :]
+    else:
+        SEMANTIC_CACHE_EMBEDDINGS = np.vstack([SEMANTIC_CACHE_EMBEDDINGS, embedding])
+    SEMANTIC_CACHE_ENTRIES.append((settings_key, cache_path))
+    return cache_path
+
+# Reference material is capped at this many tokens so multi-document uploads cannot inflate every
+# request's latency and cost or overflow the model's context window.
+REFERENCE_TOKEN_BUDGET = 6000
+EMBED_TOKEN_LIMIT = 4000 # Only the start of each long document is embedded when ranking documents
+CHARS_PER_TOKEN = 4 # Rough average for English text, used to cap the material if tokens cannot be counted
+_TOKEN_ENCODING = None
+
+def _fit(text, budget):
+    """Truncates text to at most budget tokens."""
+    global _TOKEN_ENCODING
+    if _TOKEN_ENCODING is None:
+        import tiktoken # Imported on first use
+        # cl100k_base is not Mistral's own tokenizer, but it is close enough for a budget
+        _TOKEN_ENCODING = tiktoken.get_encoding("cl100k_base")
+    token_ids = _TOKEN_ENCODING.encode(text, disallowed_special=())
+    return _TOKEN_ENCODING.decode(token_ids[:budget]) if len(token_ids) > budget else text
+
+def fit_reference_material(reference_material, topic, budget=REFERENCE_TOKEN_BUDGET):
+    """
+    Returns reference material that fits in budget tokens. When the documents are too long
+    together, the ones most similar to the topic are kept and the last one is truncated.
+    """
+    # Every token covers at least one UTF-8 byte, so material this small fits without tokenizing it
+    if not reference_material or len(reference_material.encode("utf-8")) <= budget:
+        return reference_material
+    try:
+        if _fit(reference_material, budget) == reference_material:
+            return reference_material
+        return select_reference_documents(reference_material, topic, budget)
+    except Exception as e:
+        # e.g. tiktoken could not download its encoding file on first use
+        max_chars = budget * CHARS_PER_TOKEN
+        print(f"Could not count reference material tokens ({e}). Using its first {max_chars} characters instead.")
+        return reference_material[:max_chars]
+
+def select_reference_documents(reference_material, topic, budget):
+    """Keeps the reference documents most similar to the topic, truncating the last one to fit budget tokens."""
+    # Split back into the delimited documents built in STEP 4
+    documents = [document for document in re.split(r"(?=\n--- Start of Reference Document: )", reference_material) if document.strip()]
+    embeddings = embed_texts_cached([topic] + [_fit(document, EMBED_TOKEN_LIMIT) for document in documents])
+    if embeddings is not None:
+        # Embeddings are normalized, so the dot product is the cosine similarity
+        similarities = embeddings[1:] @ embeddings[0]
+        documents = [documents[i] for i in np.argsort(-similarities, kind="stable")]
+    else:
+        print("Keeping reference documents in upload order.")
+
+    selected = []
+    remaining = budget
+    for document in documents:
+        fitted = _fit(document, remaining)
+        selected.append(fitted)
+        if fitted != document:
+            break # Budget exhausted
+        remaining -= len(_TOKEN_ENCODING.encode(document, disallowed_special=()))
+    print(f"Reference material exceeds {budget} tokens; using the most relevant {budget} tokens of it.")
+    return "".join(selected)
+
+def output_token_budget(word_count):
+    """Returns the max_tokens to request for about word_count words of output."""
+    return min(int(word_count * TOKENS_PER_WORD) + 500, MAX_OUTPUT_TOKENS)
+
 def generate_article(topic, tone, attitude, style, reference_material, min_word_count=1800, max_attempts=3):
     """
     Generates a long-form article using the Mistral API, with iterative expansion
     to meet a minimum word count.
+    Returns (article, complete), where complete is True only if the article reached
+    min_word_count and its last response finished normally (was not cut off).
     """
     if MISTRAL_API_KEY is None:
-        return "Error: Mistral API key is not configured. Please check Step 2."
+        return "Error: Mistral API key is not configured. Please check Step 2.", False
 
     current_article = ""
+    current_wc = 0 # Word count of current_article, updated whenever it changes
+    finish_reason = None # Why the last response ended; "length" means it was cut off
     attempt = 0
+    reference_material = fit_reference_material(reference_material, topic)
     
     # Mistral API uses chat message format
     # System role can be used for instructions, user for prompts.
+    # These messages do not change between attempts, so they are built once; every request
+    # then starts with a byte-identical prefix and only the continuation turns differ.
+
+    # System message for general instructions
+    system_prompt = f"""
+    You are a highly skilled AI writer specializing in long-form content.
+    Your task is to generate a comprehensive, detailed, and high-quality article.
+    Maintain a {tone} tone, an {attitude} attitude, and a {style} writing style throughout the article.
+    Ensure the article is well-structured with clear headings, subheadings, and logical flow.
+    """
+    system_msg = {"role": "system", "content": system_prompt}
+
+    # User message for content generation, including reference material
+    user_prompt_parts = []
+
+    if reference_material:
+        user_prompt_parts.append(f"Here is some reference material. Integrate relevant information naturally, but do not just copy-paste. Synthesize and analyze it:\n\nReference Material:\n{reference_material}\n\n")
+
+    user_prompt_parts.append(f"""
+    Write a detailed and comprehensive long-form article on the topic of "{topic}".
+    The article must be at least {min_word_count} words long.
+    It should include an introduction, multiple distinct body sections with appropriate headings, and a strong conclusion.
+    Provide in-depth analysis, specific examples, and relevant details to fully explore the topic.
+    """)
+    # The reference material stays in the same turn as the instructions, since the chat API
+    # expects user and assistant turns to alternate
+    article_request_msg = {"role": "user", "content": "\n".join(user_prompt_parts).strip()}
     
-    while count_words(current_article) < min_word_count and attempt < max_attempts:
+    # The first request asks for the whole article with enough output tokens for it, so further
+    # attempts only happen when the response was cut off or came back genuinely short
+    while (current_wc < min_word_count or finish_reason == "length") and attempt < max_attempts:
         attempt += 1
         print(f"\n--- Generation Attempt {attempt}/{max_attempts} ---")
 
-        messages = []
-        
-        # System message for general instructions
-        system_prompt = f"""
-        You are a highly skilled AI writer specializing in long-form content.
-        Your task is to generate a comprehensive, detailed, and high-quality article.
-        Maintain a {tone} tone, an {attitude} attitude, and a {style} writing style throughout the article.
-        Ensure the article is well-structured with clear headings, subheadings, and logical flow.
-        """
-        messages.append({"role": "system", "content": system_prompt})
-
-        # User message for content generation, including reference material and expansion logic
-        user_prompt_parts = []
-
-        if reference_material:
-            user_prompt_parts.append(f"Here is some reference material. Integrate relevant information naturally, but do not just copy-paste. Synthesize and analyze it:\n\nReference Material:\n{reference_material}\n\n")
-
-        if attempt == 1:
-            # Initial prompt for the first generation attempt
-            user_prompt_parts.append(f"""
-            Write a detailed and comprehensive long-form article on the topic of "{topic}".
-            The article must be at least {min_word_count} words long.
-            It should include an introduction, multiple distinct body sections with appropriate headings, and a strong conclusion.
-            Provide in-depth analysis, specific examples, and relevant details to fully explore the topic.
-            """)
-        else:
-            # Expansion prompt for subsequent attempts if the article is too short
-            print(f"Current article word count: {count_words(current_article)}. Expanding to reach {min_word_count} words.")
-            user_prompt_parts.append(f"""
-            The following article on "{topic}" is currently {count_words(current_article)} words long.
-            Please expand upon it to reach a total length of at least {min_word_count} words.
-            Do NOT rewrite the entire article from scratch. Instead, add more detail, deeper analysis, additional examples, or further relevant sub-sections to the existing content.
-            Maintain the original {tone} tone, {attitude} attitude, and {style} style.
-            Focus on increasing depth and clarity while seamlessly integrating new content.
-
-            Existing Article to expand:
-            {current_article}
-            """)
-        
-        messages.append({"role": "user", "content": "\n".join(user_prompt_parts).strip()})
+        messages = [system_msg, article_request_msg]
+
+        max_tokens = output_token_budget(min_word_count)
+        was_cut_off = finish_reason == "length"
+        if attempt > 1:
+            # Continue the conversation instead of asking for a rewrite: the model only writes the
+            # missing words, which are appended locally, so earlier text is never regenerated or truncated
+            deficit = max(min_word_count - current_wc, 0)
+            messages.append({"role": "assistant", "content": current_article})
+            if was_cut_off:
+                print(f"The response was cut off at {current_wc} words. Asking the model to finish it.")
+                continuation_request = "Your response was cut off. Continue exactly where it stopped, without repeating any earlier text."
+            else:
+                print(f"Current article word count: {current_wc}. Adding about {deficit} words to reach {min_word_count} words.")
+                continuation_request = f"""
+                Continue the article. Add about {deficit} more words in new sections after the existing content; do not repeat earlier text.
+                Add deeper analysis, additional examples, or further relevant sub-sections, and do not write another conclusion.
+                Return only the new sections.
+                """.strip()
+            messages.append({"role": "user", "content": f"{continuation_request}\nMaintain the original {tone} tone, {attitude} attitude, and {style} style."})
+            max_tokens = output_token_budget(max(deficit, 500))
         
         try:
             print(f"Sending request to Mistral API with model '{MISTRAL_MODEL}'...")
-            response_content = call_mistral_api(messages)
+            response_content, finish_reason = call_mistral_api(messages, max_tokens=max_tokens)
             
             if response_content:
-                current_article = response_content # The model is asked to return the *expanded* full article
-                print(f"Generated text length: {count_words(current_article)} words.")
-                if count_words(current_article) < min_word_count:
+                if attempt == 1:
+                    current_article = response_content
+                    current_wc = count_words(current_article)
+                elif was_cut_off:
+                    # Text that was cut off mid-sentence is resumed in place. A new reply rarely starts
+                    # with whitespace, so add a space where neither side has one to keep the words apart.
+                    needs_space = not (current_article[-1:].isspace() or response_content[:1].isspace())
+                    current_article = current_article + (" " if needs_space else "") + response_content
+                    # The words on either side of the join stay separate, so only the new text needs counting
+                    current_wc += count_words(response_content)
+                else:
+                    # New sections go before the existing conclusion, so the article still ends with it
+                    current_article = insert_before_conclusion(current_article, response_content)
+                    # Only the new text needs counting
+                    current_wc += count_words(response_content)
+                print(f"Generated text length: {current_wc} words.")
+                if finish_reason == "length":
+                    print("The response reached its token limit before finishing.")
+                elif current_wc < min_word_count:
                     print("Article is still too short. Attempting to expand further...")
                 else:
                     print("Target word count reached or exceeded.")
             else:
                 print("Mistral API returned an empty or errored response. Cannot proceed with generation.")
                 current_article = "ERROR: Could not generate content. Please try adjusting your prompt or inputs."
+                current_wc = count_words(current_article)
                 break # Exit loop on empty or blocked response
 
         except Exception as e:
             print(f"An unexpected error occurred during API call: {e}")
             current_article = "ERROR: Failed to generate article due to an unexpected error. Please check your inputs and API key."
+            current_wc = count_words(current_article)
             break
 
     # Final check and message after all attempts
-    if count_words(current_article) < min_word_count:
+    complete = current_wc >= min_word_count and finish_reason != "length"
+    if current_wc < min_word_count:
         print(f"\nWarning: Could not reach the target word count of {min_word_count} words after {max_attempts} attempts.")
-        print(f"Final article length: {count_words(current_article)} words.")
+        print(f"Final article length: {current_wc} words.")
         print("You may try increasing 'max_attempts' (in the code), adjusting the prompt, or providing more detailed reference material.")
+    elif finish_reason == "length":
+        print(f"\nWarning: The article ({current_wc} words) was still cut off by the token limit after {max_attempts} attempts.")
     else:
-        print(f"\nArticle generation complete! Final word count: {count_words(current_article)} words.")
+        print(f"\nArticle generation complete! Final word count: {current_wc} words.")
     
-    return current_article
+    return current_article, complete
 
 # Button to trigger article generation
 generate_button = widgets.Button(description="Generate Article")
 output_generation = widgets.Output() # Output widget for generation messages
 
+# Inputs and result of the last successful generation, so re-clicking with nothing changed
+# returns the article directly instead of hashing the reference material again or calling the API.
+# The result is only reused while its file in ARTICLE_CACHE_DIR still exists, so deleting the
+# cache forces a fresh generation here too.
+_last_key = None
+_last_article = None
+_last_cache_path = None
+
 def on_generate_clicked(b):
     """Callback function when the 'Generate Article' button is clicked."""
-    with output_generation:
-        clear_output() # Clear previous output
-        # Pre-flight checks
-        if not ARTICLE_TOPIC or not ARTICLE_TONE or not ARTICLE_ATTITUDE or not ARTICLE_STYLE:
-            print("Error: Please confirm article details in STEP 3 before generating.")
-            return
-        if MISTRAL_API_KEY is None:
-            print("Error: Mistral API is not configured. Please check STEP 2 (API Key Setup).")
-            return
-
-        print("Starting article generation process...")
-        # Call the main article generation function
-        final_article_text = generate_article(
-            topic=ARTICLE_TOPIC,
-            tone=ARTICLE_TONE,
-            attitude=ARTICLE_ATTITUDE,
-            style=ARTICLE_STYLE,
-            reference_material=REFERENCE_MATERIAL
-        )
-        global GENERATED_ARTICLE
-        GENERATED_ARTICLE = final_article_text # Store the result globally
-        print("\n--- Generation Process Completed ---")
-        print("The generated article is ready for display in the next step.")
+    global GENERATED_ARTICLE, _last_key, _last_article, _last_cache_path
+    # Disable the button while this runs so repeated clicks cannot start overlapping runs
+    b.disabled = True
+    b.description = "Generating..."
+    try:
+        with output_generation:
+            clear_output() # Clear previous output
+            # Pre-flight checks
+            if not ARTICLE_TOPIC or not ARTICLE_TONE or not ARTICLE_ATTITUDE or not ARTICLE_STYLE:
+                print("Error: Please confirm article details in STEP 3 before generating.")
+                return
+            if MISTRAL_API_KEY is None:
+                print("Error: Mistral API is not configured. Please check STEP 2 (API Key Setup).")
+                return
+            if getattr(upload_button, "_running", False):
+                print("Reference documents from STEP 4 are still being processed. Please wait for them to finish.")
+                return
+
+            # REFERENCE_MATERIAL is represented by a short hash so the key stays cheap to keep and compare
+            reference_hash = hashlib.blake2b(REFERENCE_MATERIAL.encode("utf-8"), digest_size=8).hexdigest()
+            key = (ARTICLE_TOPIC, ARTICLE_TONE, ARTICLE_ATTITUDE, ARTICLE_STYLE, MIN_WORD_COUNT, reference_hash)
+            if key == _last_key and _last_article and os.path.exists(_last_cache_path):
+                print("Nothing has changed since the last generation. Cached result reused.")
+                print(f"(Delete '{ARTICLE_CACHE_DIR}' to force a fresh generation.)")
+                GENERATED_ARTICLE = _last_article
+                print("The generated article is ready for display in the next step.")
+                return
+
+            article_details = dict(
+                topic=ARTICLE_TOPIC,
+                tone=ARTICLE_TONE,
+                attitude=ARTICLE_ATTITUDE,
+                style=ARTICLE_STYLE,
+                reference_material=REFERENCE_MATERIAL
+            )
+            # The same request (or one with a near-identical topic and the same settings) reuses the article generated earlier instead of calling the API again
+            final_article_text, cache_path = load_cached_article(min_word_count=MIN_WORD_COUNT, **article_details)
+            if final_article_text is not None:
+                print("An article was already generated from these inputs. Reusing the saved article.")
+                print(f"(Delete '{ARTICLE_CACHE_DIR}' to force a fresh generation.)")
+            else:
+                print("Starting article generation process...")
+                # Call the main article generation function
+                final_article_text, article_complete = generate_article(min_word_count=MIN_WORD_COUNT, **article_details)
+                # Only articles that reached the target and finished normally are reused; others can be retried
+                if article_complete:
+                    cache_path = store_cached_article(min_word_count=MIN_WORD_COUNT, article=final_article_text, **article_details)
+            GENERATED_ARTICLE = final_article_text # Store the result globally
+            if cache_path:
+                _last_key, _last_article, _last_cache_path = key, final_article_text, cache_path
+            print("\n--- Generation Process Completed ---")
+            print("The generated article is ready for display in the next step.")
+    finally:
+        b.disabled = False
+        b.description = "Generate Article"
 
 # Attach the callback function to the button's click event
 generate_button.on_click(on_generate_clicked)
@@ -502,19 +1043,21 @@ if GENERATED_ARTICLE:
     display(Markdown(GENERATED_ARTICLE))
     print(f"\n--- Article displayed successfully. Total words: {count_words(GENERATED_ARTICLE)} ---")
 
-    # Optional: Provide a download link for the generated article
-    try:
-        # Create a BytesIO object to simulate a file for download
-        article_bytes = GENERATED_ARTICLE.encode('utf-8')
-        b64 = base64.b64encode(article_bytes).decode() # Encode to base64
-        filename = f"generated_article_{ARTICLE_TOPIC.replace(' ', '_')[:50]}.md" # Create a filename
-
-        # HTML link to download the file
-        download_link = f'<a href="data:application/octet-stream;base64,{b64}" download="{filename}">Download Generated Article (.md)</a>'
-        display(HTML(download_link))
-        print("Download link provided above.")
-    except Exception as e:
-        print(f"Could not create download link: {e}")
+    # Optional: Offer a download of the generated article. The file is only written when the button is
+    # clicked, so no extra copy of the article (such as a base64 data URI) is kept in the notebook page.
+    # Keep the filename filesystem-safe; the topic may have been cleared by re-confirming STEP 3
+    safe_topic = re.sub(r"\W+", "_", ARTICLE_TOPIC or "article")[:50]
+    article_filename = f"generated_article_{safe_topic}.md" # Create a filename
+    download_button = widgets.Button(description="Download Article")
+
+    def on_download_clicked(b):
+        """Callback function when the 'Download Article' button is clicked."""
+        article_path = os.path.join("/content", article_filename)
+        if save_text_atomically(article_path, GENERATED_ARTICLE):
+            files.download(article_path)
+
+    download_button.on_click(on_download_clicked)
+    display(download_button)
 
 else:
     print("No article was generated. Please ensure previous steps were completed successfully and without errors.")